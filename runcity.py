@@ -2,17 +2,30 @@
 
 import argparse
 import base64
-import html.parser
-import json
+import concurrent.futures
+import contextlib
+import gzip
 import logging
+import mmap
+import multiprocessing
 import os
+import shutil
 import urllib.parse
 
-import requests
+import httpx
+import lxml.etree
+import orjson
 
 
 RUNCITY_ROOT = 'https://www.runcity.org/ru/'
-NO_ROUTE_GAMES = [
+POINTS_PATH = 'runcity_points.js'
+POINTS_EVENTS_PATH = 'cache/points_events.json'
+HTTP_WORKERS = 32
+HTTP_TIMEOUT = 60
+STREAM_CHUNK_SIZE = 64 * 1024
+MMAP_MIN_SIZE = 64 * 1024
+ROUTE_LABELS = frozenset(['Маршрут', 'Маршруты', 'Контрольные пункты', 'Маршруты соренований'])
+NO_ROUTE_GAMES = frozenset([
     'pushkin2005',
     'dobrypiter2008',
     'dobrypiter2009',
@@ -51,17 +64,63 @@ NO_ROUTE_GAMES = [
     'poets2021',
     'vdnh',  # TODO: add subgames
     'onlineintegral2021',
-]
+])
+CREATED_DIRS = set()
+
+# all pages come from one host, so with http/2 the workers share a single connection
+CLIENT = httpx.Client(
+    http2=True,
+    follow_redirects=True,
+    timeout=HTTP_TIMEOUT,
+    limits=httpx.Limits(max_connections=HTTP_WORKERS, max_keepalive_connections=HTTP_WORKERS),
+)
 
 
 def process_html(get_parser, text):
-    parser = get_parser()
+    # feed() rather than fromstring(), which rejects str pages with an xml encoding declaration
+    parser = lxml.etree.HTMLParser(target=get_parser())
     parser.feed(text)
-    parser.close()
-    return parser.get_result()
+    return parser.close()
+
+
+def process_html_stream(get_parser, chunks):
+    parser = lxml.etree.HTMLParser(target=get_parser())
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
+
+
+class HTMLTarget:
+    # lxml reports text in pieces split at entities, while the handlers expect
+    # the whole text between two tags at once, as html.parser used to give it
+    def __init__(self):
+        self.text = []
+
+    def flush(self):
+        if self.text:
+            self.handle_data(''.join(self.text))
+            self.text = []
+
+    def start(self, tag, attrs):
+        self.flush()
+        self.handle_starttag(tag, attrs)
+
+    def end(self, tag):
+        self.flush()
+        self.handle_endtag(tag)
 
+    def data(self, data):
+        self.text.append(data)
 
-class LinkParser(html.parser.HTMLParser):
+    def comment(self, text):
+        self.flush()
+
+    def close(self):
+        self.flush()
+        return self.get_result()
+
+
+class LinkParser(HTMLTarget):
     def __init__(self):
         self.links = []
         self.in_link = None
@@ -69,7 +128,7 @@ class LinkParser(html.parser.HTMLParser):
 
     def handle_starttag(self, tag, attrs):
         if tag == 'a':
-            self.in_link = dict(attrs)['href']
+            self.in_link = attrs['href']
 
     def handle_endtag(self, tag):
         if tag == 'a':
@@ -83,7 +142,7 @@ class LinkParser(html.parser.HTMLParser):
         return self.links
 
 
-class RouteParser(html.parser.HTMLParser):
+class RouteParser(HTMLTarget):
     def __init__(self):
         self.routes = []
         self.in_routes = False
@@ -94,21 +153,21 @@ class RouteParser(html.parser.HTMLParser):
 
     def handle_starttag(self, tag, attrs):
         if not self.in_routes:
-            if tag == 'dl' and dict(attrs).get('class') == 'route':
+            if tag == 'dl' and attrs.get('class') == 'route':
                 self.in_routes = True
             return
         logging.debug('BEG %s %s %s %s', tag, attrs, self.in_id, self.in_description)
         if tag == 'a':
             self.in_a = True
         if tag == 'dt':
-            self.routes.append({'id': dict(attrs)['id']})
+            self.routes.append({'id': attrs['id']})
             self.in_id = True
         if tag == 'abbr':
-            self.routes[-1][dict(attrs)['class']] = dict(attrs)['title']
-        if tag == 'dd' and dict(attrs).get('class') == 'description':
+            self.routes[-1][attrs['class']] = attrs['title']
+        if tag == 'dd' and attrs.get('class') == 'description':
             self.in_description = True
-        if self.in_id and tag == 'a' and 'link' not in self.routes[-1] and 'href' in dict(attrs):
-            self.routes[-1]['link'] = dict(attrs)['href']
+        if self.in_id and tag == 'a' and 'link' not in self.routes[-1] and 'href' in attrs:
+            self.routes[-1]['link'] = attrs['href']
 
     def handle_endtag(self, tag):
         if not self.in_routes:
@@ -137,29 +196,51 @@ class RouteParser(html.parser.HTMLParser):
         return self.routes
 
 
+@contextlib.contextmanager
+def open_atomic(fname, mode, opener=open):
+    # write next to the target and rename it into place, so a failed write
+    # leaves the previous file intact instead of a truncated one
+    tmp_fname = fname + '.tmp'
+    fobj = opener(tmp_fname, mode)
+    try:
+        with fobj:
+            yield fobj
+    except BaseException:
+        os.remove(tmp_fname)
+        raise
+    os.replace(tmp_fname, fname)
+
+
+def load_json(fname):
+    with open(fname, 'rb') as fobj:
+        if os.fstat(fobj.fileno()).st_size < MMAP_MIN_SIZE:
+            return orjson.loads(fobj.read())
+        # parse straight from the page cache instead of copying the file first
+        with mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as buf:
+            return orjson.loads(buf)
+
+
+def make_cache_dir(fname):
+    dirname = os.path.dirname(fname)
+    if dirname and dirname not in CREATED_DIRS:
+        os.makedirs(dirname, exist_ok=True)
+        CREATED_DIRS.add(dirname)
+
+
 def cache_wrapper(fname, use_cache=True):
     def decorator(func):
         def wrapper(*args, **kwargs):
-            ext = os.path.splitext(fname)[-1]
             if use_cache:
-                if os.path.dirname(fname):
-                    os.makedirs(os.path.dirname(fname), exist_ok=True)
+                make_cache_dir(fname)
                 if os.path.exists(fname):
                     logging.info('get data from %s', fname)
-                    with open(fname) as fobj:
-                        to_return = fobj.read()
-                    if ext == '.json':
-                        to_return = json.loads(to_return)
-                    return to_return
+                    return load_json(fname)
             logging.info('gen data using %s(*%s, **%s)', func, args, kwargs)
             to_return = func(*args, **kwargs)
-            to_store = to_return
-            if ext == '.json':
-                to_store = json.dumps(to_store, indent=4, sort_keys=True)
             if use_cache:
                 logging.info('write data to %s', fname)
-                with open(fname, 'w') as fobj:
-                    fobj.write(to_store)
+                with open_atomic(fname, 'wb') as fobj:
+                    fobj.write(orjson.dumps(to_return))
             return to_return
 
         return wrapper
@@ -167,32 +248,86 @@ def cache_wrapper(fname, use_cache=True):
     return decorator
 
 
-def do_get_html(url):
+def do_get_html(url, meta=None):
     logging.info('loading %s', url)
-    req = requests.get(url)
+    headers = {}
+    if meta and 'etag' in meta:
+        headers['If-None-Match'] = meta['etag']
+    if meta and 'last_modified' in meta:
+        headers['If-Modified-Since'] = meta['last_modified']
+    req = CLIENT.get(url, headers=headers)
+    if req.status_code == 304:
+        return None, meta
     req.raise_for_status()
-    return req.text
+    meta = {'etag': req.headers.get('ETag'), 'last_modified': req.headers.get('Last-Modified')}
+    return req.text, {key: value for key, value in meta.items() if value is not None}
+
+
+def iter_html(url):
+    logging.info('streaming %s', url)
+    with CLIENT.stream('GET', url) as req:
+        req.raise_for_status()
+        yield from req.iter_text(chunk_size=STREAM_CHUNK_SIZE)
+
+
+def fetch_html(fname, url):
+    meta_fname = fname + '.meta.json'
+    meta = None
+    if os.path.exists(fname + '.gz') and os.path.exists(meta_fname):
+        meta = load_json(meta_fname)
+    text, meta = do_get_html(url, meta)
+    if text is None:
+        logging.info('%s not modified, get data from %s.gz', url, fname)
+        with gzip.open(fname + '.gz', 'rt') as fobj:
+            return fobj.read()
+    # validators go last, so they never describe a body that failed to be stored
+    logging.info('write data to %s.gz', fname)
+    with open_atomic(fname + '.gz', 'wt', gzip.open) as fobj:
+        fobj.write(text)
+    with open_atomic(meta_fname, 'wb') as fobj:
+        fobj.write(orjson.dumps(meta))
+    return text
+
+
+def gzip_html_cache(fname):
+    # html caches used to be stored uncompressed
+    logging.info('compress %s', fname)
+    with open(fname, 'rb') as src, open_atomic(fname + '.gz', 'wb', gzip.open) as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(fname)
 
 
 def get_html(args, fname, url):
-    return cache_wrapper(fname, not args.disable_html_cache)(do_get_html)(url)
+    if args.disable_html_cache:
+        return do_get_html(url)[0]
+    if os.path.exists(fname):
+        gzip_html_cache(fname)
+    if not args.revalidate and os.path.exists(fname + '.gz'):
+        logging.info('get data from %s.gz', fname)
+        with gzip.open(fname + '.gz', 'rt') as fobj:
+            return fobj.read()
+    make_cache_dir(fname)
+    return fetch_html(fname, url)
 
 
 def do_get_events(args):
     url = urllib.parse.urljoin(RUNCITY_ROOT, 'events/archive')
-    text = do_get_html(url)
     events = [
         {
             'id': os.path.basename(link.rstrip('/')),
             'url': urllib.parse.urljoin(url, link),
             'title': data,
         }
-        for link, data in process_html(LinkParser, text)
+        for link, data in process_html_stream(LinkParser, iter_html(url))
         if len(data.split()) > 1 and '/events/' in link
     ]
+    parsed_ids = set()
+    if os.path.isdir('cache/parsed'):
+        with os.scandir('cache/parsed') as entries:
+            parsed_ids = {entry.name[:-len('.json')] for entry in entries if entry.name.endswith('.json')}
     for event in events:
         event['parsed_path'] = os.path.join('cache/parsed', event['id']) + '.json'
-        event['is_parsed'] = os.path.exists(event['parsed_path'])
+        event['is_parsed'] = event['id'] in parsed_ids
     return list(reversed(events))
 
 
@@ -206,19 +341,26 @@ def list_events(args):
         print('\t'.join([event['id'], event['title'], event['url'], str(event['is_parsed'])]))
 
 
-def parse_event(args, event):
-    event_main_text = get_html(args, os.path.join('cache/events', event['id']), event['url'])
-    all_routes_url = urllib.parse.urljoin(event['url'], 'routes/all/')
+def parse_event(args, event, parse_executor=None):
+    event_url = event['url']
+    event_main_text = get_html(args, os.path.join('cache/events', event['id']), event_url)
+    all_routes_url = urllib.parse.urljoin(event_url, 'routes/all/')
     for link, data in process_html(LinkParser, event_main_text):
-        if data.strip() in ['Маршрут', 'Маршруты', 'Контрольные пункты', 'Маршруты соренований']:
-            assert urllib.parse.urljoin(event['url'], link) + 'all/' == all_routes_url
+        if data in ROUTE_LABELS:
+            assert urllib.parse.urljoin(event_url, link) + 'all/' == all_routes_url
             break
     else:
         if event['id'] not in NO_ROUTE_GAMES:
-            logging.error('No routes found for %s, check %s manually', event['id'], event['url'])
+            logging.error('No routes found for %s, check %s manually', event['id'], event_url)
         return {}
 
     routes = get_html(args, os.path.join('cache/routes_all', event['id']), all_routes_url)
+    if parse_executor is None:
+        return parse_routes(all_routes_url, routes)
+    return parse_executor.submit(parse_routes, all_routes_url, routes).result()
+
+
+def parse_routes(all_routes_url, routes):
     items = process_html(RouteParser, routes)
     result = []
     for item in items:
@@ -231,43 +373,109 @@ def parse_event(args, event):
     return result
 
 
-def update_events(args):
-    features = []
-    for event in get_events(args):
-        parsed = cache_wrapper(event['parsed_path'], args.use_cache)(parse_event)(args, event)
+def parse_event_cached(args, event, parse_executor=None):
+    return cache_wrapper(event['parsed_path'], args.use_cache)(parse_event)(args, event, parse_executor)
+
+
+def get_points_events(events):
+    # everything update_events takes from the events list rather than from parsed caches
+    return [[event['id'], event['title']] for event in events]
+
+
+def is_points_up_to_date(events):
+    if not os.path.exists(POINTS_PATH) or not os.path.isdir('cache/parsed'):
+        return False
+    if not os.path.exists(POINTS_EVENTS_PATH) or load_json(POINTS_EVENTS_PATH) != get_points_events(events):
+        return False
+    with os.scandir('cache/parsed') as entries:
+        parsed_mtimes = {entry.name: entry.stat().st_mtime for entry in entries}
+    names = [os.path.basename(event['parsed_path']) for event in events]
+    if not all(name in parsed_mtimes for name in names):
+        return False
+    return max((parsed_mtimes[name] for name in names), default=0) <= os.path.getmtime(POINTS_PATH)
+
+
+def iter_features(events, parsed_events):
+    for event, parsed in zip(events, parsed_events):
+        header = event['title'] + ': '
         for item in parsed:
-            feature = {
+            url = item['url']
+            yield {
                 'type': 'Feature',
-                'id': len(features),
                 'geometry': {
                     'type': 'Point',
-                    'coordinates': [float(item['latitude']), float(item['longitude'])],
+                    'coordinates': [item['latitude'], item['longitude']],
                 },
                 'properties': {
-                    'balloonContentHeader': event['title'] + ': ' + item['title'],
+                    'balloonContentHeader': header + item['title'],
                     'balloonContentBody': item.get('description', ''),
-                    'balloonContentFooter': '<a href="{0}" target="_blank">{0}</a>'.format(item['url']),
+                    'balloonContentFooter': f'<a href="{url}" target="_blank">{url}</a>',
                 },
             }
-            features.append(feature)
-    data = {
-        "type": "FeatureCollection",
-        "features": features,
-    }
-    js_data = 'function get_runcity_points() {{return JSON.parse(atob("{}"));}}'.format(
-        base64.b64encode(json.dumps(data).encode()).decode(),
-    )
-    with open('runcity_points.js', 'w') as fobj:
-        fobj.write(js_data)
+
+
+class Base64Writer:
+    # encodes by whole 3-byte groups, so the output can be written piece by
+    # piece without holding the whole serialized collection
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.pending = b''
+
+    def write(self, data):
+        data = self.pending + data
+        size = len(data) - len(data) % 3
+        self.fobj.write(base64.b64encode(data[:size]))
+        self.pending = data[size:]
+
+    def close(self):
+        self.fobj.write(base64.b64encode(self.pending))
+        self.pending = b''
+
+
+def update_events(args):
+    events = get_events(args)
+    if args.use_cache and not args.force and is_points_up_to_date(events):
+        logging.info('%s is up to date', POINTS_PATH)
+        return
+    # event pages are fetched independently, so overlap the network round trips in threads,
+    # and parse route pages in worker processes; those are spawned rather than forked,
+    # because they start while the fetching threads are running
+    parse_context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(mp_context=parse_context) as parse_executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=HTTP_WORKERS) as executor:
+            parsed_events = list(executor.map(lambda event: parse_event_cached(args, event, parse_executor), events))
+    # atob gives a binary string, decode it back from utf-8 before parsing; a plain loop
+    # is used, since Uint8Array.from with a mapping callback is several times slower
+    with open_atomic(POINTS_PATH, 'wb') as fobj:
+        fobj.write(b'function get_runcity_points() {var s = atob("')
+        writer = Base64Writer(fobj)
+        writer.write(b'{"type":"FeatureCollection","features":[')
+        for feature_id, feature in enumerate(iter_features(events, parsed_events)):
+            if feature_id:
+                writer.write(b',')
+            feature['id'] = feature_id
+            writer.write(orjson.dumps(feature))
+        writer.write(b']}')
+        writer.close()
+        fobj.write(
+            b'"), b = new Uint8Array(s.length); '
+            b'for (var i = 0; i < s.length; i++) b[i] = s.charCodeAt(i); '
+            b'return JSON.parse(new TextDecoder().decode(b));}'
+        )
+    make_cache_dir(POINTS_EVENTS_PATH)
+    with open_atomic(POINTS_EVENTS_PATH, 'wb') as fobj:
+        fobj.write(orjson.dumps(get_points_events(events)))
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--disable-html-cache', action='store_true')
+    parser.add_argument('--revalidate', action='store_true')
     parser.add_argument('--use-cache', action='store_true')
     parser.add_argument('--cache-events', action='store_true') 
     parser.add_argument('--list', action='store_true')
     parser.add_argument('--update', action='store_true')
+    parser.add_argument('--force', action='store_true')
     parser.add_argument('--verbose', '-v', action='store_true')
     args = parser.parse_args()
 